@@ -26,6 +26,9 @@ not to post, e.g.:
   python readerbot_atp.py account.config db_file db_file force_run
   python readerbot_atp.py account.config db_file db_file test force_run
 
+Add `profile` (or set `READERBOT_PROFILE_DIR`) to write CPU and allocation
+profiles of the run; see `run_profile.py`.
+
 
 DB schema:
 
@@ -51,6 +54,7 @@ from datetime import datetime, timezone
 
 import posting_history
 import reading_list
+import run_profile
 
 
 # TODO: Bring back type annotations when my server is upgraded past Python 3.7
@@ -174,34 +178,38 @@ def main():
         return
 
     print("READERBOT_POSTING")
-    config_kv = get_config(user_cred_filename)
-    host = config_kv["ATP_HOST"]
-    username = config_kv["ATP_USERNAME"]
-    pword = config_kv["ATP_PASSWORD"]
-
-    auth_token, did = get_auth_token_and_did(
-        host=host, username=username, password=pword)
-
-    timestamp_iso = dtime_now.isoformat().replace("+00:00", "Z")
-    headers = {"Authorization": f"Bearer {auth_token}"}
-    post_params = {
-        "collection": "app.bsky.feed.post",
-        "$type": "app.bsky.feed.post",
-        "repo": "{}".format(did),
-        "record": enrich_message(next_post.message).to_json(timestamp_iso)
-    }
-    resp = requests.post(
-        f"{host}/xrpc/com.atproto.repo.createRecord",
-        json=post_params,
-        headers=headers
-    )
-    print(resp.status_code)
-    print(pprint.pprint(resp.json()))
-    if resp.status_code != 200:
-        raise RuntimeError("Posting failed!! POST_FAIL")
-    posting_history.save_update(next_post, db_filename)
+    with run_profile.phase("publish"):
+        config_kv = get_config(user_cred_filename)
+        host = config_kv["ATP_HOST"]
+        username = config_kv["ATP_USERNAME"]
+        pword = config_kv["ATP_PASSWORD"]
+
+        auth_token, did = get_auth_token_and_did(
+            host=host, username=username, password=pword)
+
+        timestamp_iso = dtime_now.isoformat().replace("+00:00", "Z")
+        headers = {"Authorization": f"Bearer {auth_token}"}
+        post_params = {
+            "collection": "app.bsky.feed.post",
+            "$type": "app.bsky.feed.post",
+            "repo": "{}".format(did),
+            "record": enrich_message(next_post.message).to_json(timestamp_iso)
+        }
+        resp = requests.post(
+            f"{host}/xrpc/com.atproto.repo.createRecord",
+            json=post_params,
+            headers=headers
+        )
+        print(resp.status_code)
+        print(pprint.pprint(resp.json()))
+        if resp.status_code != 200:
+            raise RuntimeError("Posting failed!! POST_FAIL")
+    with run_profile.phase("history"):
+        posting_history.save_update(next_post, db_filename)
 
 
 if __name__ == "__main__":
-    main()
+    with run_profile.profile_run(
+            "readerbot_atp", run_profile.cli_profile_dir(sys.argv)):
+        main()
 
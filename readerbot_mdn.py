@@ -17,6 +17,9 @@ not to post, e.g.:
   python readerbot_mdn.py user_cred.secret db_file force_run
   python readerbot_mdn.py user_cred.secret db_file test force_run
 
+Add `profile` (or set `READERBOT_PROFILE_DIR`) to write CPU and allocation
+profiles of the run; see `run_profile.py`.
+
 
 DB schema:
 
@@ -40,6 +43,7 @@ import mastodon
 
 import posting_history
 import reading_list
+import run_profile
 
 
 def main():
@@ -61,10 +65,14 @@ def main():
         return
 
     print("READERBOT_POSTING")
-    mdn = mastodon.Mastodon(access_token=user_cred_filename)
-    mdn.status_post(status=next_post.message, visibility='public')
-    posting_history.save_update(next_post, db_filename)
+    with run_profile.phase("publish"):
+        mdn = mastodon.Mastodon(access_token=user_cred_filename)
+        mdn.status_post(status=next_post.message, visibility='public')
+    with run_profile.phase("history"):
+        posting_history.save_update(next_post, db_filename)
 
 
 if __name__ == "__main__":
-    main()
+    with run_profile.profile_run(
+            "readerbot_mdn", run_profile.cli_profile_dir(sys.argv)):
+        main()
@@ -12,6 +12,9 @@ not to post, e.g.:
   python readerbot_tw.py config_file db_file force_run
   python readerbot_tw.py config_file db_file test force_run
 
+Add `profile` (or set `READERBOT_PROFILE_DIR`) to write CPU and allocation
+profiles of the run; see `run_profile.py`.
+
 DB schema:
 
     CREATE TABLE IF NOT EXISTS posts(
@@ -36,6 +39,7 @@ import tweepy
 
 import posting_history
 import reading_list
+import run_profile
 
 
 def get_config(filename):
@@ -78,12 +82,16 @@ def main():
     if "test"  in sys.argv:
         return
 
-    auth = get_auth(config_filename)
-    api = tweepy.API(auth)
-    print("READERBOT_POSTING")
-    api.update_status(next_post.message)
-    posting_history.save_update(next_post, db_filename)
+    with run_profile.phase("publish"):
+        auth = get_auth(config_filename)
+        api = tweepy.API(auth)
+        print("READERBOT_POSTING")
+        api.update_status(next_post.message)
+    with run_profile.phase("history"):
+        posting_history.save_update(next_post, db_filename)
 
 
 if __name__ == "__main__":
-    main()
+    with run_profile.profile_run(
+            "readerbot_tw", run_profile.cli_profile_dir(sys.argv)):
+        main()
@@ -15,6 +15,7 @@ from typing import Optional
 from urllib import request
 
 import posting_history
+import run_profile
 
 
 # Spreadsheet read in one row as a time, as tuples.
@@ -27,10 +28,13 @@ READ_DATA_SHEET_URL = (
 
 def get_csv_tuples() -> list[tuple[str, ...]]:
     """Loads the Google Sheets sheet as a list of tuples of strings."""
-    sheet_response = request.urlopen(READ_DATA_SHEET_URL)
-    encoding = sheet_response.headers.get_content_charset('utf-8')
-    sheet_lines = sheet_response.read().decode(encoding).split("\n")
-    return [tuple(t) for t in csv.reader(sheet_lines)]
+    with run_profile.phase("fetch"):
+        sheet_response = request.urlopen(READ_DATA_SHEET_URL)
+        encoding = sheet_response.headers.get_content_charset('utf-8')
+        sheet_body = sheet_response.read()
+    with run_profile.phase("parse"):
+        sheet_lines = sheet_body.decode(encoding).split("\n")
+        return [tuple(t) for t in csv.reader(sheet_lines)]
 
 
 @dataclasses.dataclass(frozen=True)
@@ -135,7 +139,8 @@ class BookCollection:
 
 def get_next_post(
     current_time: datetime.datetime, db_filename: str,
-    min_gap_days: int = 2, mean_gap_days: int = 6, skip_gap_check: bool=False
+    min_gap_days: int = 2, mean_gap_days: int = 6, skip_gap_check: bool=False,
+    profile_dir: Optional[str] = None
     ) -> tuple[Optional[posting_history.Post], str]:
     """Either returns a post to publish, or an explanation for why not.
 
@@ -147,6 +152,9 @@ def get_next_post(
         mean_gap_days: The target interarrival time for posts, in days.
         skip_gap_check: If True, ignore how long it's been since the last post
             when trying to return a post for this run.
+        profile_dir: If set, write a CPU and allocation profile of this call
+            to this directory; see `run_profile`. Also enabled by setting
+            `READERBOT_PROFILE_DIR`.
     
     Returns:
         - First element is either a `posting_history.Post` to publish
@@ -154,7 +162,19 @@ def get_next_post(
         - Second element is a non-empty string iff the first element is `None`,
             this string explaining why there's no post to publish right now.
     """
-    prev_post = posting_history.get_previous_update(db_filename)
+    with run_profile.profile_run("get_next_post", profile_dir):
+        return _get_next_post(
+            current_time=current_time, db_filename=db_filename,
+            min_gap_days=min_gap_days, mean_gap_days=mean_gap_days,
+            skip_gap_check=skip_gap_check)
+
+
+def _get_next_post(
+    current_time: datetime.datetime, db_filename: str,
+    min_gap_days: int, mean_gap_days: int, skip_gap_check: bool
+    ) -> tuple[Optional[posting_history.Post], str]:
+    with run_profile.phase("history"):
+        prev_post = posting_history.get_previous_update(db_filename)
     next_post_timestamp = prev_post.next_posting_timestamp_sec(
         min_gap_days=min_gap_days, mean_gap_days=mean_gap_days)
     if not skip_gap_check and (current_time.timestamp() < next_post_timestamp):
@@ -168,20 +188,21 @@ def get_next_post(
     # Cool -- it's an acceptable time to post.
     # Let's see what's going on in the reading list:
     tuples = get_csv_tuples()
-    library = BookCollection(tuples, int(current_time.timestamp()))
-    candidate_post = None
-    r = random.random()
-    print(f"Rolled a {r:0.4f}")
-    if r < 0.96:
-        candidate_post = library.current_read_msg()
+    with run_profile.phase("BookCollection"):
+        library = BookCollection(tuples, int(current_time.timestamp()))
+        candidate_post = None
+        r = random.random()
+        print(f"Rolled a {r:0.4f}")
+        if r < 0.96:
+            candidate_post = library.current_read_msg()
+            if candidate_post is None:
+                print("No currently-reading book to post!")
+                r = 0.96 + 0.04 * random.random()
+                print(f"Re-rolled a {r:0.4f}")
+        if candidate_post is None and r < 0.95:
+            candidate_post = library.page_rate_msg()
         if candidate_post is None:
-            print("No currently-reading book to post!")
-            r = 0.96 + 0.04 * random.random()
-            print(f"Re-rolled a {r:0.4f}")
-    if candidate_post is None and r < 0.95:
-        candidate_post = library.page_rate_msg()
-    if candidate_post is None:
-        candidate_post = library.num_to_go_msg()
+            candidate_post = library.num_to_go_msg()
     # Check for dups:
     if candidate_post.is_duplicate(prev_post):
         dup_msg = (
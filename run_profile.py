@@ -0,0 +1,466 @@
+"""Opt-in CPU and allocation profiling for a single ReaderBot run.
+
+Profiling is off unless you ask for it, either by setting the environment
+variable `READERBOT_PROFILE_DIR` to a directory, or by adding the argument
+`profile` to a `readerbot_*.py` command line (which writes to the current
+directory unless `READERBOT_PROFILE_DIR` says otherwise), e.g.:
+
+  READERBOT_PROFILE_DIR=/tmp/prof python readerbot_mdn.py user_cred.secret db
+  python readerbot_mdn.py user_cred.secret db_file test force_run profile
+
+A profiled run writes three files, all named `{run name}-{UTC time}-{pid}.*`:
+
+*  `.pstats`: cProfile stats for the whole run; load with `pstats.Stats`.
+*  `.collapsed`: one "phase;frame;frame;... microseconds" line per stack,
+    ready for `flamegraph.pl` or speedscope.
+*  `.alloc.txt`: wall time and the top tracemalloc allocation sites for each
+    phase, plus the top sites for the run overall.
+
+The phases are the named blocks of work wrapped in `phase(...)`: "fetch",
+"parse", "BookCollection", "history", and "publish".  Anything outside a
+phase is attributed to "other".  When profiling is off, `phase` just returns
+a shared no-op context manager, and none of the profiling modules are even
+imported, so the phases cost next to nothing.
+
+Two caveats when reading the results:
+
+*  tracemalloc runs for the whole profiled run, and it slows down every
+    allocation.  Allocation-heavy phases (parse, BookCollection) look more
+    expensive next to network-bound ones (fetch, publish) than they really
+    are.  Compare a phase against itself across runs, not against others.
+*  The allocation sites in `.alloc.txt` are net retained memory: what a phase
+    still holds when it ends, compared with when it began.  Temporaries the
+    phase allocated and freed before it ended (e.g. the decoded sheet body in
+    `get_csv_tuples`) don't show up.
+"""
+
+
+from __future__ import annotations
+
+import contextlib
+import datetime
+import os
+import sys
+import time
+
+from typing import ContextManager, Iterator, Optional, Sequence
+
+
+PROFILE_DIR_ENV = "READERBOT_PROFILE_DIR"
+# How many allocation sites to report per phase, and for the whole run.
+TOP_ALLOCATIONS = 15
+# Upper bound on call-graph nodes visited when rebuilding collapsed stacks.
+MAX_STACK_NODES = 200_000
+
+_OTHER_PHASE = "other"
+_NO_OP = contextlib.nullcontext()
+
+
+def cli_profile_dir(argv: Sequence[str]) -> Optional[str]:
+    """Where to write profiles for this command line, or None to not profile."""
+    env_dir = os.environ.get(PROFILE_DIR_ENV)
+    if env_dir:
+        return env_dir
+    if "profile" in argv:
+        return "."
+    return None
+
+
+class _RunProfiler:
+    """One cProfile for the whole run, cut into segments at phase boundaries.
+
+    cProfile only records a call once it returns, so diffing its stats at
+    consecutive phase boundaries yields exactly the calls that finished in
+    between: that segment's work.  The frames still open at a boundary give
+    the segment's stacks their callers.  The profile is never disabled
+    mid-run, since that would make it forget those open frames.
+
+    This is a class-based context manager (rather than a generator wrapped in
+    `contextlib.contextmanager`) so that entering and leaving it, and its
+    phases, leaves as few of the profiler's own frames in the profile as
+    possible; `_strip_profiler_frames` drops the rest.
+    """
+
+    def __init__(self, run_name: str, out_dir: str):
+        import cProfile
+        import tracemalloc
+        self._run_name = run_name
+        self._out_dir = out_dir
+        self._profile = cProfile.Profile()
+        # Allocations made by the profiling machinery itself:
+        self._snapshot_filters = (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, __file__),
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        )
+        # The frame that entered this run; frames above it aren't profiled.
+        self._base_frame = None
+        self._phase_stack: list[str] = []
+        self._last_stats: dict = {}
+        # (phase, frames open at the segment's end, stats at that point):
+        self._segments: list[tuple[str, tuple, dict]] = []
+        # (frames open during profiler bookkeeping, seconds it took):
+        self._overheads: list[tuple[tuple, float]] = []
+        # (phase, wall seconds, top net allocation diffs), in run order:
+        self._phase_records: list[
+            tuple[str, float, list[tracemalloc.StatisticDiff]]] = []
+        self._started_tracemalloc = False
+
+    def __enter__(self):
+        global _ACTIVE
+        import fnmatch
+        import tracemalloc
+        # Snapshot filters match with `fnmatch`, which compiles and caches
+        # each pattern on first use; do that now, before tracing, so it isn't
+        # charged to whichever phase runs first.
+        for trace_filter in self._snapshot_filters:
+            fnmatch.fnmatch("", trace_filter.filename_pattern)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        self._base_frame = sys._getframe(1)
+        _ACTIVE = self
+        self._profile.enable()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _ACTIVE
+        import tracemalloc
+        self._profile.disable()
+        _ACTIVE = None
+        self._end_segment(())
+        final_snapshot = self._snapshot()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+        self._base_frame = None
+        # A broken profile must not fail the run, nor hide why the run failed.
+        try:
+            self._write(final_snapshot)
+        except Exception as err:
+            print(f"READERBOT_PROFILE_FAIL {err!r}", file=sys.stderr)
+        return False
+
+    def _open_frames(self) -> tuple:
+        """Pstats keys of the profiled frames open now, outermost first."""
+        keys = []
+        frame = sys._getframe(1)
+        while frame is not None and frame is not self._base_frame:
+            code = frame.f_code
+            if code.co_filename != __file__:
+                keys.append(
+                    (code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        return tuple(reversed(keys))
+
+    def _end_segment(self, open_frames: tuple):
+        self._profile.snapshot_stats()
+        stats = self._profile.stats
+        phase_name = (
+            self._phase_stack[-1] if self._phase_stack else _OTHER_PHASE)
+        self._segments.append((phase_name, open_frames, stats))
+        self._last_stats = stats
+
+    def _snapshot(self):
+        import tracemalloc
+        return tracemalloc.take_snapshot().filter_traces(
+            self._snapshot_filters)
+
+    def _write(self, final_snapshot):
+        import pstats
+        os.makedirs(self._out_dir, exist_ok=True)
+        stamp = datetime.datetime.now(datetime.timezone.utc).strftime(
+            "%Y%m%dT%H%M%S.%fZ")
+        prefix = os.path.join(
+            self._out_dir, f"{self._run_name}-{stamp}-{os.getpid()}")
+        dropped = _profiler_funcs(self._last_stats)
+        run_stats = _strip_profiler_frames(self._last_stats, dropped)
+        _subtract_overheads(run_stats, self._overheads)
+        # A run that never called any Python code has nothing to dump.
+        if run_stats:
+            all_stats = pstats.Stats()
+            all_stats.stats = run_stats
+            all_stats.dump_stats(prefix + ".pstats")
+        with open(prefix + ".collapsed", "w") as outfile:
+            before: dict = {}
+            attributed: dict = {}
+            for phase_name, open_frames, now in self._segments:
+                segment = _stats_diff(
+                    now, before, attributed, open_frames, self._last_stats)
+                before = now
+                stacks = _collapsed_stacks(
+                    _strip_profiler_frames(segment, dropped), open_frames)
+                for stack, usec in stacks:
+                    outfile.write(f"{phase_name};{stack} {usec}\n")
+        with open(prefix + ".alloc.txt", "w") as outfile:
+            for phase_name, elapsed_sec, diffs in self._phase_records:
+                outfile.write(
+                    f"== {phase_name} ({elapsed_sec * 1000:.1f} ms): "
+                    "net retained ==\n")
+                for diff in diffs:
+                    outfile.write(f"{diff}\n")
+                outfile.write("\n")
+            outfile.write("== whole run: live allocations at exit ==\n")
+            for stat in final_snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                outfile.write(f"{stat}\n")
+        print(f"READERBOT_PROFILE {prefix}.{{pstats,collapsed,alloc.txt}}")
+
+
+class _Phase:
+    """Closes the run's current segment and opens one for this phase."""
+
+    def __init__(self, profiler: _RunProfiler, phase_name: str):
+        self._profiler = profiler
+        self._phase_name = phase_name
+
+    def __enter__(self):
+        profiler = self._profiler
+        start_sec = time.perf_counter()
+        open_frames = profiler._open_frames()
+        profiler._end_segment(open_frames)
+        profiler._phase_stack.append(self._phase_name)
+        self._before = profiler._snapshot()
+        self._start_sec = time.perf_counter()
+        profiler._overheads.append((open_frames, self._start_sec - start_sec))
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        profiler = self._profiler
+        start_sec = time.perf_counter()
+        elapsed_sec = start_sec - self._start_sec
+        open_frames = profiler._open_frames()
+        profiler._end_segment(open_frames)
+        profiler._phase_stack.pop()
+        after = profiler._snapshot()
+        diffs = [
+            diff for diff in after.compare_to(self._before, "lineno")
+            if diff.size_diff or diff.count_diff
+        ][:TOP_ALLOCATIONS]
+        # Free the snapshots here, not in the caller's frame once we return.
+        self._before = after = None
+        profiler._phase_records.append((self._phase_name, elapsed_sec, diffs))
+        profiler._overheads.append(
+            (open_frames, time.perf_counter() - start_sec))
+        return False
+
+
+def _stats_diff(
+    now: dict, before: dict, attributed: dict, open_frames: tuple,
+    run_stats: dict) -> dict:
+    """The calls in pstats call graph `now` that finished after `before`.
+
+    A caller's edges only show up once it has returned, so calls made by a
+    frame still open at the boundary have no edge yet.  Those are pinned on
+    the innermost of `open_frames` that `run_stats` (the whole run) says ever
+    calls the function.  `attributed` maps (caller, callee) to the edge
+    totals handed out so far and is updated in place, so an edge that shows
+    up late isn't counted twice.
+    """
+    no_edge = (0, 0, 0.0, 0.0)
+    diff = {}
+    for func, (cc, nc, tt, ct, callers) in now.items():
+        old_cc, old_nc, old_tt, old_ct, _ = before.get(
+            func, (0, 0, 0.0, 0.0, {}))
+        # In edge order, (nc, cc, tt, ct), unlike the entries themselves:
+        totals = (nc - old_nc, cc - old_cc, tt - old_tt, ct - old_ct)
+        if totals[0] <= 0:
+            continue
+        edges = {}
+        for caller, edge in callers.items():
+            done = attributed.get((caller, func), no_edge)
+            new = tuple(value - old for value, old in zip(edge, done))
+            if new[0] > 0:
+                edges[caller] = new
+        edge_calls = sum(edge[0] for edge in edges.values())
+        if edge_calls > totals[0]:
+            share = totals[0] / edge_calls
+            edges = {
+                caller: tuple(value * share for value in edge)
+                for caller, edge in edges.items()}
+        elif edge_calls < totals[0]:
+            rest = tuple(
+                total - sum(edge[i] for edge in edges.values())
+                for i, total in enumerate(totals))
+            known = run_stats.get(func, (0, 0, 0.0, 0.0, {}))[4]
+            caller = next(
+                (f for f in reversed(open_frames) if f in known), None)
+            if caller is not None:
+                edges[caller] = tuple(
+                    a + b for a, b in zip(edges.get(caller, no_edge), rest))
+        for caller, edge in edges.items():
+            done = attributed.get((caller, func), no_edge)
+            attributed[(caller, func)] = tuple(
+                a + b for a, b in zip(done, edge))
+        diff[func] = (totals[1], totals[0], totals[2], totals[3], edges)
+    return diff
+
+
+def _profiler_funcs(raw_stats: dict) -> set:
+    """This module's functions in a call graph, plus whatever only they call.
+
+    E.g. `snapshot_stats`, and the `time.perf_counter` calls in `_Phase`.
+    """
+    dropped = {func for func in raw_stats if func[0] == __file__}
+    changed = True
+    while changed:
+        changed = False
+        for func, (_, _, _, _, callers) in raw_stats.items():
+            if func not in dropped and callers and all(
+                    caller in dropped or caller[0] == __file__
+                    for caller in callers):
+                dropped.add(func)
+                changed = True
+    return dropped
+
+
+def _strip_profiler_frames(
+    raw_stats: dict, dropped: Optional[set] = None) -> dict:
+    """Drops the profiler's own functions from a pstats call graph.
+
+    Also takes calls they made to shared functions (`len`, say) out of those
+    functions' totals.  `dropped` defaults to `_profiler_funcs(raw_stats)`;
+    pass the whole run's set when stripping a segment, whose callers may not
+    all be visible yet.
+    """
+    if dropped is None:
+        dropped = _profiler_funcs(raw_stats)
+
+    def is_profiler(func):
+        return func[0] == __file__ or func in dropped
+
+    stripped = {}
+    for func, (cc, nc, tt, ct, callers) in raw_stats.items():
+        if is_profiler(func):
+            continue
+        kept = {}
+        for caller, edge in callers.items():
+            if is_profiler(caller):
+                # Edges are (nc, cc, tt, ct), unlike the entries themselves.
+                nc, cc = nc - edge[0], cc - edge[1]
+                tt, ct = tt - edge[2], ct - edge[3]
+            else:
+                kept[caller] = edge
+        stripped[func] = (cc, nc, tt, ct, kept)
+    return stripped
+
+
+def _subtract_overheads(
+    raw_stats: dict, overheads: list[tuple[tuple, float]]):
+    """Takes profiler bookkeeping time out of the frames that were open for it.
+
+    The bookkeeping's own frames are stripped, but its time still lands in the
+    cumulative time of every frame (and caller edge) open while it ran.
+    """
+    for open_frames, seconds in overheads:
+        seen = set()
+        for i, func in enumerate(open_frames):
+            if func not in raw_stats or func in seen:
+                continue
+            seen.add(func)
+            cc, nc, tt, ct, callers = raw_stats[func]
+            raw_stats[func] = (cc, nc, tt, max(ct - seconds, tt), callers)
+            caller = open_frames[i - 1] if i else None
+            if caller in callers:
+                e_nc, e_cc, e_tt, e_ct = callers[caller][:4]
+                callers[caller] = (
+                    e_nc, e_cc, e_tt, max(e_ct - seconds, e_tt))
+
+
+def _frame_name(func: tuple[str, int, str]) -> str:
+    filename, lineno, func_name = func
+    if filename == "~":  # Built-ins, e.g. "<built-in method time.sleep>"
+        return func_name
+    return f"{func_name} ({os.path.basename(filename)}:{lineno})"
+
+
+def _collapsed_stacks(
+    raw_stats: dict, open_frames: tuple = ()) -> Iterator[tuple[str, int]]:
+    """Rebuild (stack, self-time microseconds) pairs from a pstats call graph.
+
+    cProfile only records caller/callee edges, not full stacks, so a callee's
+    time along each path is estimated by scaling its per-caller totals by the
+    share of the caller's time that came in along that path.  Paths that
+    carry under half a microsecond are pruned, and at most `MAX_STACK_NODES`
+    nodes are visited, so call graphs with many shared callees stay cheap.
+
+    Calls whose caller isn't in `raw_stats` hang off `open_frames`, the frames
+    still running when those calls finished; calls with no caller at all are
+    roots.
+    """
+    callees: dict = {func: [] for func in raw_stats}
+    # (function, stack above it, tt, ct) to start walking from:
+    starts = []
+    for func, (_, _, tt, ct, callers) in raw_stats.items():
+        for caller, edge in callers.items():
+            if caller in callees:
+                callees[caller].append(func)
+            else:
+                starts.append(
+                    (func, _stack_through(open_frames, caller), *edge[2:4]))
+            tt, ct = tt - edge[2], ct - edge[3]
+        if round(tt * 1e6) > 0 or round(ct * 1e6) > 0:
+            starts.append((func, (), max(tt, 0.0), max(ct, 0.0)))
+    nodes_left = MAX_STACK_NODES
+
+    def walk(func, stack, tt, ct):
+        nonlocal nodes_left
+        nodes_left -= 1
+        if nodes_left < 0:
+            return
+        stack = stack + (func,)
+        self_usec = round(tt * 1e6)
+        if self_usec > 0:
+            yield ";".join(_frame_name(f) for f in stack), self_usec
+        total_ct = raw_stats[func][3]
+        if total_ct <= 0:
+            return
+        scale = ct / total_ct
+        for callee in callees[func]:
+            _, _, edge_tt, edge_ct = raw_stats[callee][4][func][:4]
+            if callee in stack:
+                # A recursive call: the callee's own callees are walked from
+                # its outermost frame already, but this edge's self-time isn't.
+                usec = round(edge_tt * scale * 1e6)
+                if usec > 0:
+                    yield ";".join(
+                        _frame_name(f) for f in stack + (callee,)), usec
+                continue
+            if round(edge_ct * scale * 1e6) == 0:
+                continue
+            yield from walk(callee, stack, edge_tt * scale, edge_ct * scale)
+
+    for func, stack, tt, ct in starts:
+        yield from walk(func, stack, tt, ct)
+    if nodes_left < 0:
+        print(f"READERBOT_PROFILE_FAIL collapsed stacks truncated after "
+              f"{MAX_STACK_NODES} call-graph nodes", file=sys.stderr)
+
+
+def _stack_through(open_frames: tuple, caller) -> tuple:
+    """The open frames down to (the innermost) `caller`, or () if not open."""
+    for i in range(len(open_frames) - 1, -1, -1):
+        if open_frames[i] == caller:
+            return open_frames[:i + 1]
+    return ()
+
+
+# The profiler for the run in progress, if any; `phase` checks this.
+_ACTIVE: Optional[_RunProfiler] = None
+
+
+def profile_run(
+    run_name: str, out_dir: Optional[str] = None) -> ContextManager[None]:
+    """Profiles the enclosed block if `out_dir` or READERBOT_PROFILE_DIR is set.
+
+    Nested calls (e.g. `get_next_post` inside a profiled `readerbot_*.py` run)
+    just join the outer run's profile.
+    """
+    out_dir = out_dir or os.environ.get(PROFILE_DIR_ENV)
+    if not out_dir or _ACTIVE is not None:
+        return _NO_OP
+    return _RunProfiler(run_name, out_dir)
+
+
+def phase(phase_name: str) -> ContextManager[None]:
+    """Attributes the enclosed block's CPU time and allocations to a phase."""
+    if _ACTIVE is None:
+        return _NO_OP
+    return _Phase(_ACTIVE, phase_name)
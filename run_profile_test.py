@@ -0,0 +1,292 @@
+"""Tests for run_profile.py.
+
+Run with:
+  python -m unittest run_profile_test
+"""
+
+
+import cProfile
+import glob
+import io
+import os
+import pstats
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from unittest import mock
+
+import run_profile
+
+
+def _fetch_work():
+    return sorted(str(i) for i in range(20000))
+
+
+def _parse_work():
+    return [s.split(",") for s in ("a,b,c",) * 20000]
+
+
+def _leaf(n):
+    return sum(range(n))
+
+
+def _shared(n):
+    return _leaf(n) + _leaf(n // 2)
+
+
+def _left():
+    return _shared(20000)
+
+
+def _right():
+    return _shared(40000)
+
+
+def _phased_fetch():
+    with run_profile.phase("fetch"):
+        _fetch_work()
+
+
+def _after_fetch():
+    return _fetch_work()
+
+
+def _phased_main():
+    _phased_fetch()
+    _after_fetch()
+
+
+def _graph_workload():
+    for _ in range(20):
+        _left()
+        _right()
+
+
+class ProfileRunTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.out_dir = self._tmp.name
+        env = mock.patch.dict(os.environ)
+        env.start()
+        self.addCleanup(env.stop)
+        os.environ.pop(run_profile.PROFILE_DIR_ENV, None)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def _output(self, suffix):
+        paths = glob.glob(os.path.join(self.out_dir, f"*{suffix}"))
+        self.assertEqual(len(paths), 1, paths)
+        with open(paths[0]) as infile:
+            return infile.read()
+
+    def test_writes_all_three_files(self):
+        with run_profile.profile_run("test_run", self.out_dir):
+            with run_profile.phase("fetch"):
+                _fetch_work()
+        names = sorted(os.listdir(self.out_dir))
+        self.assertEqual(len(names), 3)
+        for name, suffix in zip(names, (".alloc.txt", ".collapsed", ".pstats")):
+            self.assertTrue(name.startswith("test_run-"), name)
+            self.assertTrue(name.endswith(suffix), name)
+        stats = pstats.Stats(os.path.join(self.out_dir, names[2]))
+        self.assertTrue(
+            any(func[2] == "_fetch_work" for func in stats.stats))
+
+    def test_phases_get_their_own_work(self):
+        with run_profile.profile_run("test_run", self.out_dir):
+            with run_profile.phase("fetch"):
+                _fetch_work()
+            with run_profile.phase("parse"):
+                _parse_work()
+        for line in self._output(".collapsed").splitlines():
+            if "_fetch_work" in line:
+                self.assertTrue(line.startswith("fetch;"), line)
+            if "_parse_work" in line:
+                self.assertTrue(line.startswith("parse;"), line)
+        alloc = self._output(".alloc.txt")
+        self.assertIn("== fetch (", alloc)
+        self.assertIn("== parse (", alloc)
+        self.assertNotIn("(+0 B)", alloc)
+
+    def test_callers_survive_phase_boundaries(self):
+        with run_profile.profile_run("test_run", self.out_dir):
+            _phased_main()
+        paths = glob.glob(os.path.join(self.out_dir, "*.pstats"))
+        stats = {
+            func[2]: value
+            for func, value in pstats.Stats(paths[0]).stats.items()}
+        main_ct = stats["_phased_main"][3]
+        self.assertGreaterEqual(
+            main_ct, stats["_phased_fetch"][3] + stats["_after_fetch"][3])
+        self.assertGreaterEqual(main_ct, stats["_fetch_work"][3])
+        callers = lambda name: {func[2] for func in stats[name][4]}
+        self.assertEqual(callers("_phased_fetch"), {"_phased_main"})
+        self.assertEqual(callers("_after_fetch"), {"_phased_main"})
+        self.assertEqual(
+            callers("_fetch_work"), {"_phased_fetch", "_after_fetch"})
+        lines = self._output(".collapsed").splitlines()
+        fetch_lines = [
+            line for line in lines
+            if "_fetch_work" in line and "_after_fetch" not in line]
+        after_lines = [line for line in lines if "_after_fetch" in line]
+        self.assertTrue(fetch_lines)
+        self.assertTrue(after_lines)
+        for line in fetch_lines:
+            self.assertRegex(
+                line, r"^fetch;_phased_main [^;]*;_phased_fetch [^;]*;"
+                r"_fetch_work ")
+        for line in after_lines:
+            self.assertRegex(
+                line, r"^other;_phased_main [^;]*;_after_fetch ")
+
+    def test_profiler_frames_are_left_out(self):
+        with run_profile.profile_run("test_run", self.out_dir):
+            with run_profile.phase("fetch"):
+                _fetch_work()
+        collapsed = self._output(".collapsed")
+        self.assertNotIn("run_profile.py", collapsed)
+        self.assertNotIn("contextlib.py", collapsed)
+        self.assertNotIn("contextlib.py", self._output(".alloc.txt"))
+
+    def test_nested_run_joins_outer_run(self):
+        with run_profile.profile_run("outer", self.out_dir):
+            with run_profile.profile_run("inner", self.out_dir):
+                with run_profile.phase("parse"):
+                    _parse_work()
+        names = os.listdir(self.out_dir)
+        self.assertEqual(len(names), 3)
+        self.assertTrue(all(name.startswith("outer-") for name in names))
+        self.assertIn("parse;", self._output(".collapsed"))
+
+    def test_env_var_turns_profiling_on(self):
+        os.environ[run_profile.PROFILE_DIR_ENV] = self.out_dir
+        with run_profile.profile_run("test_run"):
+            _fetch_work()
+        self.assertEqual(len(os.listdir(self.out_dir)), 3)
+
+    def test_off_writes_nothing(self):
+        with run_profile.profile_run("test_run"):
+            with run_profile.phase("fetch"):
+                _fetch_work()
+        self.assertEqual(os.listdir(self.out_dir), [])
+        self.assertIs(run_profile.phase("fetch"), run_profile.phase("parse"))
+
+    def test_off_imports_no_profilers(self):
+        loaded = subprocess.run(
+            [sys.executable, "-c",
+             "import sys, run_profile\n"
+             "with run_profile.profile_run('test_run'):\n"
+             "    with run_profile.phase('fetch'):\n"
+             "        pass\n"
+             "print(sorted({'cProfile', 'pstats', 'tracemalloc'}"
+             " & set(sys.modules)))"],
+            cwd=os.path.dirname(os.path.abspath(run_profile.__file__)),
+            capture_output=True, text=True, check=True).stdout
+        self.assertEqual(loaded.strip(), "[]")
+
+    def test_write_failure_does_not_hide_run_error(self):
+        not_a_dir = os.path.join(self.out_dir, "file")
+        with open(not_a_dir, "w") as outfile:
+            outfile.write("")
+        with self.assertRaisesRegex(RuntimeError, "POST_FAIL"):
+            with run_profile.profile_run("test_run", not_a_dir):
+                raise RuntimeError("Posting failed!! POST_FAIL")
+        self.assertIsNone(run_profile._ACTIVE)
+
+    def test_cli_profile_dir(self):
+        self.assertIsNone(run_profile.cli_profile_dir(["bot.py", "test"]))
+        self.assertEqual(
+            run_profile.cli_profile_dir(["bot.py", "profile"]), ".")
+        os.environ[run_profile.PROFILE_DIR_ENV] = self.out_dir
+        self.assertEqual(
+            run_profile.cli_profile_dir(["bot.py", "profile"]), self.out_dir)
+
+
+class CollapsedStacksTest(unittest.TestCase):
+
+    def test_diamond_self_times_add_up(self):
+        # A calls B and C, which both call D.
+        a, b, c, d = (("m.py", i, name) for i, name in enumerate("ABCD"))
+        raw_stats = {
+            a: (1, 1, 0.001, 0.010, {}),
+            b: (1, 1, 0.003, 0.004, {a: (1, 1, 0.003, 0.004)}),
+            c: (1, 1, 0.004, 0.005, {a: (1, 1, 0.004, 0.005)}),
+            d: (2, 2, 0.002, 0.002, {
+                b: (1, 1, 0.001, 0.001), c: (1, 1, 0.001, 0.001)}),
+        }
+        stacks = dict(run_profile._collapsed_stacks(raw_stats))
+        self.assertEqual(stacks, {
+            "A (m.py:0)": 1000,
+            "A (m.py:0);B (m.py:1)": 3000,
+            "A (m.py:0);B (m.py:1);D (m.py:3)": 1000,
+            "A (m.py:0);C (m.py:2)": 4000,
+            "A (m.py:0);C (m.py:2);D (m.py:3)": 1000,
+        })
+
+    def test_real_self_times_add_up_to_pstats_totals(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        _graph_workload()
+        profile.disable()
+        raw_stats = run_profile._strip_profiler_frames(
+            pstats.Stats(profile).stats)
+        total_usec = sum(tt for (_, _, tt, _, _) in raw_stats.values()) * 1e6
+        stacks = list(run_profile._collapsed_stacks(raw_stats))
+        rebuilt_usec = sum(usec for _, usec in stacks)
+        # Each line rounds to the nearest microsecond, and sub-microsecond
+        # paths are pruned, so allow a little slack per line.
+        self.assertAlmostEqual(
+            rebuilt_usec, total_usec, delta=max(2 * len(stacks), 10))
+
+    def _layered_stats(self, layers):
+        # Each layer has two functions, each called from both functions of
+        # the layer above: 2**layers paths, though very little time on each.
+        funcs = [[("m.py", 2 * i + j, f"f{i}_{j}") for j in range(2)]
+                 for i in range(layers)]
+        raw_stats = {}
+        for i, layer in enumerate(funcs):
+            ct = 1e-6 * (layers - i)
+            for func in layer:
+                callers = {
+                    caller: (1, 1, 1e-6 / 2, ct / 2)
+                    for caller in (funcs[i - 1] if i else ())}
+                raw_stats[func] = (2, 2, 1e-6, ct, callers)
+        return raw_stats
+
+    def test_layered_shared_callees_are_pruned(self):
+        with mock.patch("sys.stderr", new_callable=io.StringIO) as stderr:
+            stacks = list(
+                run_profile._collapsed_stacks(self._layered_stats(40)))
+        self.assertLess(len(stacks), 1000)
+        self.assertEqual(stderr.getvalue(), "")
+
+    def test_node_budget_warns_when_hit(self):
+        with mock.patch.object(run_profile, "MAX_STACK_NODES", 50), \
+                mock.patch("sys.stderr", new_callable=io.StringIO) as stderr:
+            stacks = list(
+                run_profile._collapsed_stacks(self._layered_stats(40)))
+        self.assertLessEqual(len(stacks), 50)
+        self.assertIn("READERBOT_PROFILE_FAIL", stderr.getvalue())
+        self.assertIn("truncated", stderr.getvalue())
+
+    def test_recursive_self_time_is_kept(self):
+        # A calls R, which calls itself once.
+        a, r = ("m.py", 0, "A"), ("m.py", 1, "R")
+        raw_stats = {
+            a: (1, 1, 0.001, 0.004, {}),
+            r: (1, 2, 0.003, 0.003, {
+                a: (1, 1, 0.002, 0.003), r: (1, 0, 0.001, 0.001)}),
+        }
+        stacks = dict(run_profile._collapsed_stacks(raw_stats))
+        self.assertEqual(stacks, {
+            "A (m.py:0)": 1000,
+            "A (m.py:0);R (m.py:1)": 2000,
+            "A (m.py:0);R (m.py:1);R (m.py:1)": 1000,
+        })
+
+if __name__ == "__main__":
+    unittest.main()